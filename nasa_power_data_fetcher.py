@@ -6,14 +6,29 @@ Uses YAML configuration file for easy customization and documentation.
 """
 
 import yaml
-import requests
+import orjson
+import httpx
+from aiolimiter import AsyncLimiter
+import asyncio
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 import os
-import time
+import hashlib
 import logging
 from datetime import datetime, date
 from typing import Dict, List, Optional
 import sys
+from email.utils import formatdate
+from dataclasses import dataclass
+
+# Prefer the libyaml-backed loader when PyYAML was built with it
+try:
+    from yaml import CSafeLoader as _YAMLLoader
+except ImportError:
+    from yaml import SafeLoader as _YAMLLoader
 
 # Configure logging
 logging.basicConfig(
@@ -24,25 +39,150 @@ logging.basicConfig(
         logging.StreamHandler(sys.stdout)
     ]
 )
+# httpx (the HTTP client) logs every request at INFO; keep the console to this script's messages
+logging.getLogger('httpx').setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
+# NASA POWER parameters mapped to descriptive column names: Update as required
+PARAM_MAPPING = {
+    'T2M': 'air_temp_c',
+    'T2M_MAX': 'air_temp_max_c',
+    'T2MDEW': 'dewpoint_temp_c',
+    'ALLSKY_SFC_SW_DWN': 'solar_radiation_kwh_m2',
+    'WS2M': 'wind_speed_ms',
+    'WS2M_MAX': 'wind_speed_max_ms',
+    'WD2M': 'wind_direction_deg',
+    'WD2M_MAX': 'wind_direction_max_deg',
+    'CLOUD_AMT_DAY': 'cloud_cover_pct',
+    'PRECTOTCORR': 'precipitation_mm',
+}
+WEATHER_COLUMNS = list(PARAM_MAPPING.values())
+
+# HTTP status codes that are retried with exponential backoff
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Supported output file formats, mapped to their file extensions
+OUTPUT_FORMATS = {'parquet': 'parquet', 'csv': 'csv'}
+
+@dataclass(slots=True)
+class Site:
+    """Location metadata for a configured site."""
+    code: str
+    lat: float
+    lon: float
+    points: str
+
+def _read_bytes(path: str) -> bytes:
+    """Read a file's contents as bytes."""
+    with open(path, 'rb') as f:
+        return f.read()
+
+def _write_bytes(path: str, content: bytes) -> None:
+    """Atomically write bytes to a file, replacing any existing contents."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+class _TableWriter:
+    """Incrementally writes DataFrames with the same columns to one CSV or Parquet file."""
+    
+    def __init__(self, filepath: str, output_format: str):
+        self.filepath = filepath
+        self.output_format = output_format
+        self._parquet_writer: Optional[pq.ParquetWriter] = None
+        self._started = False
+    
+    def write(self, df: pd.DataFrame) -> None:
+        """Append a DataFrame to the output file, creating the file on first write."""
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        
+        if self.output_format == 'parquet':
+            if self._parquet_writer is None:
+                self._parquet_writer = pq.ParquetWriter(self.filepath, table.schema, compression='zstd')
+            self._parquet_writer.write_table(table)
+        else:
+            # Write dates as YYYY-MM-DD rather than full timestamps
+            date_idx = table.schema.get_field_index('date')
+            table = table.set_column(date_idx, 'date', table['date'].cast(pa.date32()))
+            
+            with open(self.filepath, 'ab' if self._started else 'wb') as f:
+                # Header is written by hand so it stays unquoted, as with pandas
+                if not self._started:
+                    f.write((','.join(df.columns) + '\n').encode())
+                pa_csv.write_csv(table, f, pa_csv.WriteOptions(include_header=False, quoting_style='none'))
+        
+        self._started = True
+    
+    def close(self) -> None:
+        """Finalize the output file."""
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+    
+    def __enter__(self) -> '_TableWriter':
+        return self
+    
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
 class NASAPowerDataFetcher:
     """Fetches weather data from NASA POWER API."""
     
     def __init__(self, config_file: str = 'config.yaml'):
         """Initialize with YAML configuration file."""
         self.config = self._load_config(config_file)
+        
+        # Site metadata resolved once from the config, with types normalized so
+        # every site's frames share one schema (YAML may give int or float
+        # coordinates, quoted or unquoted POINTS)
+        self.sites = {
+            site_code: Site(
+                code=site_code,
+                lat=float(self.config[site_code]['lat']),
+                lon=float(self.config[site_code]['long']),
+                points=str(self.config[site_code]['POINTS'])
+            )
+            for site_code in self.config['sites']
+        }
+        
         self.base_url = "https://power.larc.nasa.gov/api/temporal/daily/point"
-        self.session = requests.Session()
         
-        # Create output directory
-        os.makedirs(self.config.get('output_directory', 'nasa_power_data'), exist_ok=True)
+        # Query parameters shared by every request
+        self._base_params = {
+            'parameters': ','.join(self.config['api_settings']['parameters']),
+            'community': self.config['api_settings']['community'],
+            'format': 'json'
+        }
+        
+        # Concurrency limits for the async fetch layer
+        api_settings = self.config['api_settings']
+        self.max_connections = 16
+        self.max_concurrent_requests = api_settings.get('max_concurrent_requests', 8)
+        self.max_requests_per_second = api_settings.get('max_requests_per_second', 5)
+        self._limiter: Optional[AsyncLimiter] = None
+        self.max_retries = 5
+        self.backoff_factor = 0.5
+        
+        # Processed DataFrames, shared by per-site and combined outputs
+        self._site_df_cache: Dict[str, pd.DataFrame] = {}
+        
+        # Output file format: Parquet by default, CSV on request
+        self.output_format = self.config.get('output_format', 'parquet')
+        if self.output_format not in OUTPUT_FORMATS:
+            logger.error(f"Unsupported output_format '{self.output_format}' (expected one of: {', '.join(OUTPUT_FORMATS)})")
+            sys.exit(1)
+        
+        # Create output directory and raw JSON response cache
+        output_dir = self.config.get('output_directory', 'nasa_power_data')
+        self.raw_dir = os.path.join(output_dir, 'raw')
+        os.makedirs(self.raw_dir, exist_ok=True)
         
     def _load_config(self, config_file: str) -> Dict:
         """Load configuration from YAML file."""
         try:
             with open(config_file, 'r') as f:
-                config = yaml.safe_load(f)
+                config = yaml.load(f, Loader=_YAMLLoader)
             logger.info(f"Loaded configuration from {config_file}")
             return config
         except FileNotFoundError:
@@ -52,162 +192,294 @@ class NASAPowerDataFetcher:
             logger.error(f"Error parsing YAML configuration file: {e}")
             sys.exit(1)
     
-    def _build_api_url(self, site_info: Dict, year: int) -> str:
-        """Build NASA POWER API URL for a specific site and year."""
-        params = {
-            'parameters': ','.join(self.config['api_settings']['parameters']),
-            'community': self.config['api_settings']['community'],
-            'longitude': site_info['long'],
-            'latitude': site_info['lat'],
+    def _build_api_params(self, site: Site, year: int) -> Dict:
+        """Build NASA POWER API query parameters for a specific site and year."""
+        return {
+            **self._base_params,
+            'longitude': site.lon,
+            'latitude': site.lat,
             'start': f"{year}0101",
-            'end': f"{year}1231",
-            'format': 'json'
+            'end': f"{year}1231"
         }
-        
-        # Build query string
-        query_string = '&'.join([f"{k}={v}" for k, v in params.items()])
-        return f"{self.base_url}?{query_string}"
     
-    def _fetch_data(self, site_code: str, year: int) -> Optional[Dict]:
+    async def _fetch_data(self, client: httpx.AsyncClient, site: Site, year: int) -> Optional[Dict]:
         """Fetch data from NASA POWER API for a specific site and year."""
-        site_info = self.config[site_code]
-        url = self._build_api_url(site_info, year)
+        params = self._build_api_params(site, year)
+        
+        # Key the cache on the full query so config changes (parameters,
+        # community, coordinates) never reuse a response for a different request
+        digest = hashlib.sha1(orjson.dumps(params, option=orjson.OPT_SORT_KEYS)).hexdigest()[:12]
+        raw_path = os.path.join(self.raw_dir, f"{site.code}_{year}_{digest}.json")
+        
+        cached = None
+        cached_mtime = None
+        if os.path.exists(raw_path):
+            try:
+                cached_mtime = os.path.getmtime(raw_path)
+                cached = orjson.loads(await asyncio.to_thread(_read_bytes, raw_path))
+            except (OSError, ValueError) as e:
+                logger.warning(f"Ignoring unreadable cache file {raw_path}: {e}")
         
-        logger.info(f"Fetching data for {site_code} ({year}): {site_info['lat']}, {site_info['long']}")
+        # Archive data for a year is final once the year is over, so a response
+        # saved after the year ended can be reused without a request
+        if cached is not None and datetime.fromtimestamp(cached_mtime).year > year:
+            logger.info(f"Loaded cached data for {site.code} {year} from {raw_path}")
+            return cached
+        
+        # A response saved during its own year may be partial; revalidate it instead
+        headers = {}
+        if cached is not None:
+            headers['If-Modified-Since'] = formatdate(cached_mtime, usegmt=True)
+        
+        logger.info(f"Fetching data for {site.code} ({year}): {site.lat}, {site.lon}")
         
         try:
-            response = self.session.get(url, timeout=30)
-            response.raise_for_status()
+            content = await self._get_content(client, params, headers)
+            if content is None:
+                logger.info(f"Cached data for {site.code} {year} is up to date")
+                return cached
             
-            data = response.json()
+            data = orjson.loads(content)
             
             if 'properties' not in data or 'parameter' not in data['properties']:
-                logger.error(f"Invalid response structure for {site_code} {year}")
-                return None
+                logger.error(f"Invalid response structure for {site.code} {year}")
+                return self._cached_fallback(cached, site, year)
+            
+            # Save the response bytes as received; no re-serialization needed
+            await asyncio.to_thread(_write_bytes, raw_path, content)
                 
-            logger.info(f"Successfully fetched data for {site_code} {year}")
+            logger.info(f"Successfully fetched data for {site.code} {year}")
             return data
             
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error fetching data for {site_code} {year}: {e}")
-            return None
+        except httpx.HTTPError as e:
+            logger.error(f"Error fetching data for {site.code} {year}: {e}")
+            return self._cached_fallback(cached, site, year)
         except Exception as e:
-            logger.error(f"Error parsing JSON response for {site_code} {year}: {e}")
-            return None
+            logger.error(f"Error parsing JSON response for {site.code} {year}: {e}")
+            return self._cached_fallback(cached, site, year)
+    
+    def _cached_fallback(self, cached: Optional[Dict], site: Site, year: int) -> Optional[Dict]:
+        """Return the cached copy, if any, after a failed revalidation."""
+        if cached is not None:
+            logger.warning(f"Revalidation failed for {site.code} {year}, using cached copy")
+        return cached
     
-    def _process_site_data(self, site_code: str) -> pd.DataFrame:
-        """Process all years of data for a single site."""
-        all_data = []
-        site_info = self.config[site_code]
+    async def _get_content(self, client: httpx.AsyncClient, params: Dict,
+                           headers: Optional[Dict] = None) -> Optional[bytes]:
+        """GET the API endpoint and return the raw body, or None if it was not modified.
         
-        for year in self.config['years']:
-            # Add delay to respect API rate limits
-            time.sleep(1)
-            
-            raw_data = self._fetch_data(site_code, year)
-            if raw_data is None:
-                logger.warning(f"Skipping {site_code} {year} due to fetch error")
-                continue
-            
-            # Extract parameter data
-            parameters = raw_data['properties']['parameter']
-            
-            # Get all dates from the first parameter
-            first_param = list(parameters.keys())[0]
-            dates = list(parameters[first_param].keys())
-            
-            # Process each date
-            for date_str in dates:
-                row = {
-                    'site_code': site_code,
-                    'points': site_info['POINTS'],
-                    'latitude': site_info['lat'],
-                    'longitude': site_info['long'],
-                    'date': date_str,
-                    'year': int(date_str[:4]),
-                    'month': int(date_str[4:6]),
-                    'day': int(date_str[6:8])
-                }
-                
-                # Add weather parameters with descriptive names: Update as required
-                param_mapping = {
-                    'T2M': 'air_temp_c',
-                    'T2M_MAX': 'air_temp_max_c',
-                    'T2MDEW': 'dewpoint_temp_c',
-                    'ALLSKY_SFC_SW_DWN': 'solar_radiation_kwh_m2',
-                    'WS2M': 'wind_speed_ms',
-                    'WS2M_MAX': 'wind_speed_max_ms',
-                    'WD2M': 'wind_direction_deg',
-                    'WD2M_MAX': 'wind_direction_max_deg',
-                    'CLOUD_AMT_DAY': 'cloud_cover_pct',
-                    'PRECTOTCORR': 'precipitation_mm',
-                }
-                
-                for nasa_param, col_name in param_mapping.items():
-                    if nasa_param in parameters:
-                        value = parameters[nasa_param].get(date_str)
-                        # Handle NASA POWER missing data values (-999)
-                        row[col_name] = None if value == -999 else value
-                    else:
-                        row[col_name] = None
+        Transient failures are retried with exponential backoff.
+        """
+        # Callers outside _fetch_all_async get a limiter bound to the current loop
+        if self._limiter is None:
+            self._limiter = AsyncLimiter(self.max_requests_per_second, time_period=1.0)
+        
+        for attempt in range(self.max_retries + 1):
+            delay = self.backoff_factor * (2 ** attempt)
+            try:
+                async with self._limiter:
+                    response = await client.get(self.base_url, params=params, headers=headers)
+                if response.status_code == 304:
+                    return None
+                if response.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                    response.raise_for_status()
+                    return response.content
+                logger.warning(f"HTTP {response.status_code} from NASA POWER API, retrying in {delay:.1f}s")
+            except httpx.TransportError as e:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"Request failed ({e!r}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+    
+    async def _fetch_all_async(self, sites: List[str], write_site_files: bool = False) -> None:
+        """Fetch and process every configured site concurrently."""
+        sem = asyncio.Semaphore(self.max_concurrent_requests)
+        
+        # Token bucket shared by every request in this run, created here so it
+        # belongs to the running event loop
+        self._limiter = AsyncLimiter(self.max_requests_per_second, time_period=1.0)
+        
+        # One pooled client for all requests; HTTP/2 multiplexes them over a single connection
+        limits = httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections,
+                              keepalive_expiry=30)
+        async with httpx.AsyncClient(http2=True, limits=limits, timeout=30.0) as client:
+            tasks = [
+                asyncio.create_task(self._process_site_async(client, sem, self.sites[site_code], write_site_files))
+                for site_code in sites
+            ]
+            await asyncio.gather(*tasks)
+    
+    async def _process_site_async(self, client: httpx.AsyncClient, sem: asyncio.Semaphore,
+                                  site: Site, write_site_files: bool) -> None:
+        """Fetch all years for a site, writing each year to its output file as soon as it is in order."""
+        queue: asyncio.Queue = asyncio.Queue()
+        years = sorted(self.config['years'])
+        
+        # Producers: fetch and parse one year each, then hand the frame to the consumer
+        async def _produce(year: int) -> None:
+            frame = None
+            try:
+                # Semaphore bounds in-flight requests to respect API rate limits
+                async with sem:
+                    raw_data = await self._fetch_data(client, site, year)
+                if raw_data is None:
+                    logger.warning(f"Skipping {site.code} {year} due to fetch error")
+                else:
+                    frame = self._build_year_frame(site, raw_data)
+            except Exception as e:
+                logger.error(f"Unexpected error processing {site.code} {year}: {e}")
+            await queue.put((year, frame))
+        
+        producers = [asyncio.create_task(_produce(year)) for year in years]
+        
+        # Consumer: years arrive in completion order, but are written in
+        # calendar order so the output stays sorted by date
+        filepath = self._site_output_path(site.code)
+        writer = _TableWriter(filepath, self.output_format)
+        arrived: Dict[int, Optional[pd.DataFrame]] = {}
+        year_frames = []
+        next_idx = 0
+        try:
+            for _ in years:
+                year, frame = await queue.get()
+                arrived[year] = frame
                 
-                all_data.append(row)
+                while next_idx < len(years) and years[next_idx] in arrived:
+                    frame = arrived.pop(years[next_idx])
+                    next_idx += 1
+                    if frame is None:
+                        continue
+                    if write_site_files:
+                        # Disk writes run in a worker thread so other fetches keep progressing
+                        await asyncio.to_thread(writer.write, frame)
+                    year_frames.append(frame)
+        finally:
+            await asyncio.to_thread(writer.close)
+        
+        await asyncio.gather(*producers)
         
-        if not all_data:
-            logger.warning(f"No data collected for site {site_code}")
-            return pd.DataFrame()
+        if not year_frames:
+            logger.warning(f"No data collected for site {site.code}")
+            self._site_df_cache[site.code] = pd.DataFrame()
+            return
         
-        df = pd.DataFrame(all_data)
-        df['date'] = pd.to_datetime(df['date'], format='%Y%m%d')
-        df = df.sort_values(['date']).reset_index(drop=True)
+        # Year frames share one site_code category, so the concat stays categorical
+        df = pd.concat(year_frames, ignore_index=True)
         
-        logger.info(f"Processed {len(df)} records for site {site_code}")
-        return df
+        logger.info(f"Processed {len(df)} records for site {site.code}")
+        if write_site_files:
+            logger.info(f"Saved {len(df)} records to {filepath}")
+        self._site_df_cache[site.code] = df
+    
+    def _build_year_frame(self, site: Site, raw_data: Dict) -> pd.DataFrame:
+        """Build a DataFrame from one year of NASA POWER data for a site."""
+        # Extract parameter data
+        parameters = raw_data['properties']['parameter']
+        
+        # Get all dates from the first parameter
+        first_param = next(iter(parameters))
+        date_keys = list(parameters[first_param])
+        dates = np.array(date_keys, dtype='U8')
+        n_dates = len(dates)
+        parsed_dates = pd.to_datetime(dates, format='%Y%m%d', cache=True)
+        
+        # Build the year's columns directly as arrays instead of per-date rows.
+        # site_code is categorical here so per-year and per-site frames share
+        # one output schema.
+        columns = {
+            'site_code': pd.Categorical.from_codes(np.zeros(n_dates, dtype=np.int8), [site.code]),
+            'points': site.points,
+            'latitude': site.lat,
+            'longitude': site.lon,
+            'date': parsed_dates,
+            'year': parsed_dates.year.astype('int16'),
+            'month': parsed_dates.month.astype('int8'),
+            'day': parsed_dates.day.astype('int8')
+        }
+        
+        # Parameters present in this response, resolved once per year
+        present = [(i, nasa_param) for i, nasa_param in enumerate(PARAM_MAPPING) if nasa_param in parameters]
+        
+        # Weather values as one column-major block; missing parameters stay NaN
+        weather = np.full((n_dates, len(PARAM_MAPPING)), np.nan, dtype=np.float32, order='F')
+        for i, nasa_param in present:
+            values = parameters[nasa_param]
+            weather[:, i] = np.fromiter((values.get(d, np.nan) for d in date_keys), dtype=np.float32, count=n_dates)
+        
+        # Handle NASA POWER missing data values (-999) in a single vectorized pass
+        weather[weather == -999] = np.nan
+        columns.update(zip(WEATHER_COLUMNS, weather.T))
+        
+        return pd.DataFrame(columns)
+    
+    def _load_all_site_data(self) -> Dict[str, pd.DataFrame]:
+        """Return processed data for every configured site, fetching only uncached sites."""
+        pending = [site_code for site_code in self.config['sites'] if site_code not in self._site_df_cache]
+        
+        if pending:
+            asyncio.run(self._fetch_all_async(pending))
+        
+        return {site_code: self._site_df_cache[site_code] for site_code in self.config['sites']}
+    
+    def _output_path(self, prefix: str) -> str:
+        """Return an output file path for the configured years and output format."""
+        output_dir = self.config.get('output_directory', 'nasa_power_data')
+        extension = OUTPUT_FORMATS[self.output_format]
+        filename = f"{prefix}_daily_weather_{min(self.config['years'])}-{max(self.config['years'])}.{extension}"
+        return os.path.join(output_dir, filename)
+    
+    def _site_output_path(self, site_code: str) -> str:
+        """Return the output file path for an individual site."""
+        return self._output_path(site_code)
     
     def fetch_all_data(self) -> None:
-        """Fetch data for all sites and save to CSV files."""
+        """Fetch data for all sites and save one output file per site."""
         logger.info("Starting data collection process")
         
-        for site_code in self.config['sites']:
-            logger.info(f"Processing site: {site_code}")
-            
-            site_df = self._process_site_data(site_code)
-            
+        # Uncached sites are written year by year while their fetches are still running
+        pending = [site_code for site_code in self.config['sites'] if site_code not in self._site_df_cache]
+        cached = [site_code for site_code in self.config['sites'] if site_code not in pending]
+        
+        if pending:
+            asyncio.run(self._fetch_all_async(pending, write_site_files=True))
+        
+        for site_code in cached:
+            site_df = self._site_df_cache[site_code]
             if site_df.empty:
                 logger.warning(f"No data to save for site {site_code}")
                 continue
             
             # Save individual site data
-            output_dir = self.config.get('output_directory', 'nasa_power_data')
-            filename = f"{site_code}_daily_weather_{min(self.config['years'])}-{max(self.config['years'])}.csv"
-            filepath = os.path.join(output_dir, filename)
-            
-            site_df.to_csv(filepath, index=False)
+            filepath = self._site_output_path(site_code)
+            with _TableWriter(filepath, self.output_format) as writer:
+                writer.write(site_df)
             logger.info(f"Saved {len(site_df)} records to {filepath}")
         
         logger.info("Data collection complete!")
     
     def create_combined_file(self) -> None:
-        """Create a combined CSV file with all sites."""
+        """Create a combined output file with all sites."""
         logger.info("Creating combined dataset")
         
-        all_sites_data = []
+        site_data = self._load_all_site_data()
         
-        for site_code in self.config['sites']:
-            site_df = self._process_site_data(site_code)
-            if not site_df.empty:
-                all_sites_data.append(site_df)
+        filepath = self._output_path('all_sites')
         
-        if all_sites_data:
-            combined_df = pd.concat(all_sites_data, ignore_index=True)
-            combined_df = combined_df.sort_values(['site_code', 'date']).reset_index(drop=True)
-            
-            output_dir = self.config.get('output_directory', 'nasa_power_data')
-            filename = f"all_sites_daily_weather_{min(self.config['years'])}-{max(self.config['years'])}.csv"
-            filepath = os.path.join(output_dir, filename)
-            
-            combined_df.to_csv(filepath, index=False)
-            logger.info(f"Saved combined dataset with {len(combined_df)} records to {filepath}")
+        # Stream one site at a time instead of materializing the full combined
+        # frame. Site frames are already sorted by date, so writing them in site
+        # order yields the combined (site_code, date) ordering.
+        total_records = 0
+        with _TableWriter(filepath, self.output_format) as writer:
+            for site_code in sorted(site_data):
+                site_df = site_data[site_code]
+                if site_df.empty:
+                    continue
+                
+                writer.write(site_df)
+                total_records += len(site_df)
+        
+        if total_records:
+            logger.info(f"Saved combined dataset with {total_records} records to {filepath}")
         else:
             logger.warning("No data available to create combined file")
     
@@ -220,9 +492,8 @@ class NASAPowerDataFetcher:
         logger.info(f"  Output directory: {self.config.get('output_directory', 'nasa_power_data')}")
         
         # Show site coordinates
-        for site_code in self.config['sites']:
-            site_info = self.config[site_code]
-            logger.info(f"  {site_code}: {site_info['lat']}, {site_info['long']}")
+        for site in self.sites.values():
+            logger.info(f"  {site.code}: {site.lat}, {site.lon}")
 
 def main():
     """Main execution function."""